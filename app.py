@@ -2,9 +2,12 @@
 import streamlit as st
 import pandas as pd
 import io
-import plotly.express as px
-import plotly.graph_objects as go
+import xlsxwriter
 import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import numpy as np
 
 # Try to import openai, handle if not installed
@@ -15,13 +18,26 @@ except ImportError:
     OPENAI_AVAILABLE = False
     openai = None
 
+# Prefer the Rust-backed calamine reader when it is installed
+try:
+    import python_calamine  # noqa: F401
+    CALAMINE_AVAILABLE = True
+except ImportError:
+    CALAMINE_AVAILABLE = False
+
 # Configuration
 HISTORICAL_REQUIRED_COLS = ["BRANDPRODUCT", "Item Code", "TON", "Item Name"]
+HISTORICAL_REQUIRED_UPPER = [col.upper() for col in HISTORICAL_REQUIRED_COLS]  # header matching is case-insensitive
+DATE_COLUMN_KEYWORDS = ['date', 'time', 'month', 'period']
+TARGET_MAX_ROWS = 200  # BNI target sheets keep their categories near the top
+BRAND_KEYWORD_PATTERN = re.compile(
+    r'(?P<mfg>mfg)|(?P<scg>scg)|(?P<mizu>mizu)|(?P<pipe>pipe)'
+    r'|(?P<conduit>conduit)|(?P<fitting>fitting)|(?P<valve>valve)|(?P<icon>icon)'
+)
 
 # Get API key from environment
 OPENAI_API_KEY = None
 try:
-    import os
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
     if not OPENAI_API_KEY:
         try:
@@ -31,28 +47,51 @@ try:
 except:
     pass
 
-def process_historical_file(uploaded_file):
+def read_excel_upload(file_bytes, file_name="", **kwargs):
+    """Read uploaded Excel bytes with calamine, or openpyxl as a fallback"""
+    buffer = io.BytesIO(file_bytes)
+    if CALAMINE_AVAILABLE:
+        kwargs.setdefault('engine', 'calamine')
+        return pd.read_excel(buffer, **kwargs)
+    
+    if not str(file_name).lower().endswith('.xls'):
+        kwargs.setdefault('engine', 'openpyxl')
+    return pd.read_excel(buffer, **kwargs)
+
+def safe_ratio(numerator, denominator, default=0.0):
+    """numerator / denominator, or default when there is nothing to divide by"""
+    return numerator / denominator if denominator > 0 else default
+
+def is_historical_column(col_name):
+    """Keep required columns plus any date-like column the month filter can use"""
+    name_upper = str(col_name).upper()
+    name_lower = name_upper.lower()
+    return (any(req_upper in name_upper for req_upper in HISTORICAL_REQUIRED_UPPER)
+            or any(date_word in name_lower for date_word in DATE_COLUMN_KEYWORDS))
+
+@st.cache_data(show_spinner=False)
+def process_historical_file(file_bytes, file_name=""):
     """Process uploaded historical data Excel file - Fixed for pyarrow compatibility"""
     try:
-        # Try different header positions with explicit dtype
+        # Try different header positions on a small probe read, then read the sheet once
         header_positions = [0, 1, 2]
         df = None
         
+        header_probe = read_excel_upload(file_bytes, file_name, header=None, dtype=str,
+                                         nrows=len(header_positions))
         for header_pos in header_positions:
-            try:
-                # Read with dtype=str to avoid pyarrow issues
-                temp_df = pd.read_excel(uploaded_file, header=header_pos, dtype=str)
-                cols_found = sum(1 for col in HISTORICAL_REQUIRED_COLS 
-                               if any(req_col.upper() in str(temp_col).upper() 
-                                     for temp_col in temp_df.columns 
-                                     for req_col in [col]))
-                
-                if cols_found >= 3:
-                    df = temp_df
-                    st.success(f"✅ Found valid headers at row {header_pos + 1}")
-                    break
-            except Exception as e:
-                continue
+            if header_pos >= len(header_probe):
+                break
+            header_cells = [str(cell).upper() for cell in header_probe.iloc[header_pos]]
+            cols_found = sum(1 for req_upper in HISTORICAL_REQUIRED_UPPER
+                             if any(req_upper in cell for cell in header_cells))
+            
+            if cols_found >= 3:
+                # Read with dtype=str to avoid pyarrow issues, skipping columns nothing downstream uses
+                df = read_excel_upload(file_bytes, file_name, header=header_pos, dtype=str,
+                                       usecols=is_historical_column)
+                st.success(f"✅ Found valid headers at row {header_pos + 1}")
+                break
         
         if df is None:
             st.error("❌ Could not find valid headers in the file")
@@ -60,9 +99,10 @@ def process_historical_file(uploaded_file):
         
         # Map columns
         column_mapping = {}
-        for req_col in HISTORICAL_REQUIRED_COLS:
-            for df_col in df.columns:
-                if req_col.upper() in str(df_col).upper():
+        upper_columns = [(df_col, str(df_col).upper()) for df_col in df.columns]
+        for req_col, req_upper in zip(HISTORICAL_REQUIRED_COLS, HISTORICAL_REQUIRED_UPPER):
+            for df_col, col_upper in upper_columns:
+                if req_upper in col_upper:
                     column_mapping[df_col] = req_col
                     break
         
@@ -77,8 +117,9 @@ def process_historical_file(uploaded_file):
         # Clean data with proper type conversion and error handling
         original_count = len(df)
         
-        # Convert TON column with better error handling
-        df['TON'] = pd.to_numeric(df['TON'].astype(str).str.replace(',', ''), errors='coerce')
+        # Convert TON column with better error handling (skip if the reader already typed it)
+        if not pd.api.types.is_numeric_dtype(df['TON']):
+            df['TON'] = pd.to_numeric(df['TON'].astype(str).str.replace(',', ''), errors='coerce')
         df = df.dropna(subset=['TON'])
         df = df[df['TON'] > 0]
         df = df.dropna(subset=['BRANDPRODUCT', 'Item Code'])
@@ -94,15 +135,24 @@ def process_historical_file(uploaded_file):
         df = df[df['Item Code'] != '']
         df = df[df['Item Code'] != 'nan']
         
+        # Categorical keys let every downstream groupby hash integer codes instead of strings
+        for col in ['BRANDPRODUCT', 'Item Code', 'Item Name']:
+            df[col] = df[col].astype('category')
+        
+        # Remaining text columns move to Arrow strings
+        extra_cols = df.columns.difference(HISTORICAL_REQUIRED_COLS)
+        if len(extra_cols):
+            df[extra_cols] = df[extra_cols].convert_dtypes(dtype_backend='pyarrow')
+        
         st.write(f"📊 **Data Summary:** {len(df):,} valid records from {original_count:,} total rows")
         
         # Brand summary with error handling
         try:
-            brand_summary = df.groupby('BRANDPRODUCT').agg({
-                'Item Code': 'nunique',
-                'TON': ['count', 'sum']
+            brand_summary = df.groupby('BRANDPRODUCT', observed=True).agg(**{
+                'Unique SKUs': ('Item Code', 'nunique'),
+                'Records': ('TON', 'size'),
+                'Total TON': ('TON', 'sum')
             }).round(2)
-            brand_summary.columns = ['Unique SKUs', 'Records', 'Total TON']
             brand_summary = brand_summary.sort_values('Total TON', ascending=False)
             
             st.dataframe(brand_summary, use_container_width=True)
@@ -115,90 +165,83 @@ def process_historical_file(uploaded_file):
         st.error(f"Error processing historical file: {e}")
         return None
 
-def process_target_file(uploaded_file):
+@st.cache_data(show_spinner=False)
+def process_target_file(file_bytes, file_name=""):
     """Process BNI Sales Rolling target file - Fixed for pyarrow compatibility"""
     try:
-        # Read with explicit dtype to avoid pyarrow issues
-        df = pd.read_excel(uploaded_file, sheet_name=0, header=None, dtype=str)
+        # Read with explicit dtype to avoid pyarrow issues. A small full-width read
+        # covers the preview and the header search.
+        preview_df = read_excel_upload(file_bytes, file_name, sheet_name=0, header=None, dtype=str,
+                                       nrows=10)
         
         st.write("🔍 **Target File Preview:**")
-        st.dataframe(df.head(10))
+        st.dataframe(preview_df)
         
-        if len(df) < 3:
+        if len(preview_df) < 3:
             st.error("❌ File has insufficient data")
             return None
         
-        # Find May and W1 columns
-        may_col_idx = None
-        w1_col_idx = None
-        
-        for row_idx in range(min(3, len(df))):
-            for col_idx in range(len(df.columns)):
-                try:
-                    cell_value = str(df.iloc[row_idx, col_idx]).strip().lower()
-                    if 'may' in cell_value and may_col_idx is None:
-                        may_col_idx = col_idx
-                    elif 'w1' in cell_value and w1_col_idx is None:
-                        w1_col_idx = col_idx
-                except:
-                    continue
-        
-        if may_col_idx is None:
-            may_col_idx = 1
-        if w1_col_idx is None:
-            w1_col_idx = 2
+        # Find May and W1 columns - first matching header cell in row-major order
+        header_cells = preview_df.head(3).astype(str).apply(lambda col: col.str.strip().str.lower())
+        may_mask = header_cells.apply(lambda col: col.str.contains('may', regex=False)).to_numpy(dtype=bool)
+        w1_mask = header_cells.apply(lambda col: col.str.contains('w1', regex=False)).to_numpy(dtype=bool, copy=True)
+        
+        may_col_idx = 1
+        w1_col_idx = 2
+        
+        may_hits = np.argwhere(may_mask)
+        if len(may_hits):
+            may_row, may_col_idx = (int(pos) for pos in may_hits[0])
+            w1_mask[may_row, may_col_idx] = False  # a cell is claimed by May first
+        
+        w1_hits = np.argwhere(w1_mask)
+        if len(w1_hits):
+            w1_col_idx = int(w1_hits[0][1])
+        
+        # Second pass reads only the category, May and W1 columns
+        data_cols = sorted({col_idx for col_idx in (0, may_col_idx, w1_col_idx)
+                            if col_idx < len(preview_df.columns)})
+        df = read_excel_upload(file_bytes, file_name, sheet_name=0, header=None, dtype=str,
+                               nrows=TARGET_MAX_ROWS, usecols=data_cols)
         
         # Find data range
         start_row_idx = 2
-        end_row_idx = len(df)
-        
-        for i in range(start_row_idx, len(df)):
-            if i < len(df):
-                try:
-                    cell_value = str(df.iloc[i, 0]).strip().lower()
-                    if 'total' in cell_value:
-                        end_row_idx = i
-                        break
-                except:
-                    continue
-        
-        # Extract categories with better error handling
-        category_data = []
-        for i in range(start_row_idx, end_row_idx):
-            if i < len(df):
-                try:
-                    category_name = df.iloc[i, 0]
-                    may_value = df.iloc[i, may_col_idx] if may_col_idx < len(df.columns) else "0"
-                    w1_value = df.iloc[i, w1_col_idx] if w1_col_idx < len(df.columns) else "0"
-                    
-                    if pd.notna(category_name) and str(category_name).strip() != '' and str(category_name).strip() != 'nan':
-                        try:
-                            may_value = float(str(may_value).replace(',', '').strip()) if pd.notna(may_value) and str(may_value).strip() != 'nan' else 0
-                        except:
-                            may_value = 0
-                        
-                        try:
-                            w1_value = float(str(w1_value).replace(',', '').strip()) if pd.notna(w1_value) and str(w1_value).strip() != 'nan' else 0
-                        except:
-                            w1_value = 0
-                        
-                        category_data.append({
-                            'Category': str(category_name).strip(),
-                            'MayTarget': may_value,
-                            'W1Target': w1_value
-                        })
-                except Exception as e:
-                    continue
-        
-        if category_data:
-            st.write(f"📋 **Extracted {len(category_data)} categories**")
+
+        # Vectorized scan of the first column for the Total row
+        def find_total_rows(frame):
+            col0 = frame[0].iloc[start_row_idx:].astype(str).str.strip().str.lower()
+            return col0.str.contains('total', regex=False) | col0.str.contains('รวม', regex=False)
+
+        total_mask = find_total_rows(df)
+        if not total_mask.any() and len(df) >= TARGET_MAX_ROWS:
+            # No Total row within the capped read: read the whole sheet rather than drop categories
+            df = read_excel_upload(file_bytes, file_name, sheet_name=0, header=None, dtype=str,
+                                   usecols=data_cols)
+            total_mask = find_total_rows(df)
+        end_row_idx = total_mask.idxmax() if total_mask.any() else len(df)
+
+        # Extract categories as whole column slices instead of per-cell lookups
+        block = df.iloc[start_row_idx:end_row_idx]
+        
+        def target_values(col_idx):
+            if col_idx not in block.columns:
+                return np.zeros(len(block))
+            values = block[col_idx].astype(str).str.replace(',', '').str.strip()
+            return pd.to_numeric(values, errors='coerce').fillna(0).to_numpy(dtype=float)
+        
+        category_names = block[0].astype(str).str.strip()
+        valid = (block[0].notna() & (category_names != '') & (category_names != 'nan')).to_numpy()
+        category_names = category_names.to_numpy()[valid].tolist()
+        may_values = target_values(may_col_idx)[valid].tolist()
+        w1_values = target_values(w1_col_idx)[valid].tolist()
+        
+        if category_names:
+            st.write(f"📋 **Extracted {len(category_names)} categories**")
             
-            category_targets = {}
-            for item in category_data:
-                category_targets[item['Category']] = {
-                    'mayTarget': item['MayTarget'],
-                    'w1Target': item['W1Target']
-                }
+            category_targets = {
+                category: {'mayTarget': may_value, 'w1Target': w1_value}
+                for category, may_value, w1_value in zip(category_names, may_values, w1_values)
+            }
             
             return category_targets
         else:
@@ -209,6 +252,7 @@ def process_target_file(uploaded_file):
         st.error(f"Error processing target file: {e}")
         return None
 
+@st.cache_data(show_spinner=False)
 def filter_historical_by_month(historical_df, target_month="May"):
     """Filter historical data by month for proper comparison"""
     if historical_df is None or historical_df.empty:
@@ -217,7 +261,7 @@ def filter_historical_by_month(historical_df, target_month="May"):
     # Look for date columns
     date_columns = []
     for col in historical_df.columns:
-        if any(date_word in str(col).lower() for date_word in ['date', 'time', 'month', 'period']):
+        if any(date_word in str(col).lower() for date_word in DATE_COLUMN_KEYWORDS):
             date_columns.append(col)
     
     # If we find date columns, try to filter by month
@@ -246,71 +290,81 @@ def filter_historical_by_month(historical_df, target_month="May"):
     st.info("📅 Using all historical data (no date filtering applied)")
     return historical_df
 
+@st.cache_data(show_spinner=False)
 def map_categories_to_brands(category_targets, historical_df):
     """Map categories to brands with optimized processing"""
     historical_summary = {}
     if historical_df is not None and not historical_df.empty:
         try:
-            hist_summary = historical_df.groupby('BRANDPRODUCT')['TON'].sum()
-            historical_summary = hist_summary.to_dict()
+            # Single-key sum: a weighted bincount over the brand codes
+            brand_codes, brands = pd.factorize(historical_df['BRANDPRODUCT'], sort=False)
+            has_brand = brand_codes >= 0
+            brand_totals = np.bincount(brand_codes[has_brand],
+                                       weights=historical_df['TON'].to_numpy(dtype=np.float64)[has_brand],
+                                       minlength=len(brands))
+            historical_summary = dict(zip(brands, brand_totals.tolist()))
         except Exception as e:
             historical_summary = {}
     
-    brand_targets_agg = {}
-    processed_count = 0
-    skipped_count = 0
+    categories = list(category_targets.keys())
+    cats = pd.Series(categories, dtype=object).astype(str).str.lower().str.strip()
     
-    for category, targets in category_targets.items():
-        cat_lower = str(category).lower().strip()
-        
-        if 'mfg' not in cat_lower:
-            skipped_count += 1
-            continue
-        
-        # Determine brand
-        if 'scg' in cat_lower:
-            if 'pipe' in cat_lower or 'conduit' in cat_lower:
-                matching_brand = 'SCG-PI'
-            elif 'fitting' in cat_lower:
-                matching_brand = 'SCG-FT'
-            elif 'valve' in cat_lower:
-                matching_brand = 'SCG-BV'
-            else:
-                matching_brand = 'SCG-PI'
-        elif 'mizu' in cat_lower:
-            if 'fitting' in cat_lower:
-                matching_brand = 'MIZU-FT'
-            else:
-                matching_brand = 'MIZU-PI'
-        elif 'icon' in cat_lower or 'micon' in cat_lower:
-            matching_brand = 'ICON-PI'
-        elif 'pipe' in cat_lower:
-            matching_brand = 'SCG-PI'
-        elif 'fitting' in cat_lower:
-            matching_brand = 'SCG-FT'
-        elif 'valve' in cat_lower:
-            matching_brand = 'SCG-BV'
-        else:
-            matching_brand = category.replace(' ', '-').upper()
-
-        historical_tonnage = historical_summary.get(matching_brand, 0)
-        
-        if matching_brand not in brand_targets_agg:
-            brand_targets_agg[matching_brand] = {
-                'mayTarget': 0,
-                'w1Target': 0,
-                'categories': [],
-                'historicalTonnage': historical_tonnage
-            }
-        
-        may_target = targets.get('mayTarget', 0)
-        w1_target = targets.get('w1Target', 0)
-        
-        brand_targets_agg[matching_brand]['mayTarget'] += may_target
-        brand_targets_agg[matching_brand]['w1Target'] += w1_target
-        brand_targets_agg[matching_brand]['categories'].append(category)
-        
-        processed_count += 1
+    # One scan per category finds every keyword; flags are then per-keyword booleans
+    keyword_flags = (
+        cats.str.extractall(BRAND_KEYWORD_PATTERN).notna()
+        .groupby(level=0).any()
+        .reindex(range(len(cats)), fill_value=False)
+    )
+    
+    def has(keyword):
+        return keyword_flags[keyword].to_numpy(dtype=bool)
+    
+    is_mfg = has('mfg')
+    is_scg = has('scg')
+    is_mizu = has('mizu')
+    is_pipe = has('pipe')
+    is_conduit = has('conduit')
+    is_fitting = has('fitting')
+    is_valve = has('valve')
+    is_icon = has('icon')
+    
+    # Determine brand - conditions are evaluated in priority order
+    fallback_brands = pd.Series(categories, dtype=object).astype(str).str.replace(' ', '-').str.upper()
+    matching_brands = np.select(
+        [
+            is_scg & (is_pipe | is_conduit), is_scg & is_fitting, is_scg & is_valve, is_scg,
+            is_mizu & is_fitting, is_mizu,
+            is_icon,
+            is_pipe, is_fitting, is_valve
+        ],
+        [
+            'SCG-PI', 'SCG-FT', 'SCG-BV', 'SCG-PI',
+            'MIZU-FT', 'MIZU-PI',
+            'ICON-PI',
+            'SCG-PI', 'SCG-FT', 'SCG-BV'
+        ],
+        default=fallback_brands.to_numpy(dtype=object)
+    )
+    
+    mapped = pd.DataFrame({
+        'Category': categories,
+        'Brand': matching_brands,
+        'mayTarget': [targets.get('mayTarget', 0) for targets in category_targets.values()],
+        'w1Target': [targets.get('w1Target', 0) for targets in category_targets.values()]
+    })[is_mfg]
+    
+    processed_count = len(mapped)
+    skipped_count = len(categories) - processed_count
+    
+    brand_targets_agg = {}
+    if processed_count > 0:
+        grouped = mapped.groupby('Brand', sort=False).agg(
+            mayTarget=('mayTarget', 'sum'),
+            w1Target=('w1Target', 'sum'),
+            categories=('Category', list)
+        )
+        grouped['historicalTonnage'] = [historical_summary.get(brand, 0) for brand in grouped.index]
+        brand_targets_agg = grouped.to_dict('index')
     
     if processed_count > 0:
         st.success(f"✅ Processed {processed_count} MFG categories")
@@ -322,7 +376,7 @@ def map_categories_to_brands(category_targets, historical_df):
         summary_data = []
         for brand, targets in brand_targets_agg.items():
             historical_tonnage = targets['historicalTonnage']
-            may_ratio = targets['mayTarget'] / historical_tonnage if historical_tonnage > 0 else 0
+            may_ratio = safe_ratio(targets['mayTarget'], historical_tonnage)
             
             summary_data.append({
                 'Brand': brand,
@@ -338,6 +392,7 @@ def map_categories_to_brands(category_targets, historical_df):
     
     return {}, brand_targets_agg
 
+@st.cache_data(show_spinner=False)
 def predict_sku_distribution(brand_targets_agg, historical_df):
     """Predict SKU distribution"""
     if historical_df is None or historical_df.empty:
@@ -346,49 +401,59 @@ def predict_sku_distribution(brand_targets_agg, historical_df):
 
     st.write("📈 **Generating SKU Distribution Predictions...**")
     
-    brand_sku_tonnage = historical_df.groupby(['BRANDPRODUCT', 'Item Code', 'Item Name'])['TON'].sum().reset_index()
-    brand_total_tonnage = brand_sku_tonnage.groupby('BRANDPRODUCT')['TON'].sum().rename('TotalBrandTon').reset_index()
-    brand_sku_percentages = pd.merge(brand_sku_tonnage, brand_total_tonnage, on='BRANDPRODUCT')
+    brand_sku_percentages = historical_df.groupby(['BRANDPRODUCT', 'Item Code', 'Item Name'], observed=True)['TON'].sum().reset_index()
+    brand_sku_percentages['TotalBrandTon'] = brand_sku_percentages.groupby('BRANDPRODUCT', sort=False, observed=True)['TON'].transform('sum')
     brand_sku_percentages['Percentage'] = brand_sku_percentages['TON'] / brand_sku_percentages['TotalBrandTon']
     
+    # Attach brand targets and compute both period tonnages as column operations
+    brand_targets_df = pd.DataFrame({
+        'mayTarget': {brand: targets['mayTarget'] for brand, targets in brand_targets_agg.items()},
+        'w1Target': {brand: targets['w1Target'] for brand, targets in brand_targets_agg.items()}
+    })
+    brand_skus = brand_sku_percentages.join(brand_targets_df, on='BRANDPRODUCT', how='inner')
+    brand_skus['mayTon'] = brand_skus['Percentage'] * brand_skus['mayTarget']
+    brand_skus['w1Ton'] = brand_skus['Percentage'] * brand_skus['w1Target']
+    
+    brand_sku_counts = brand_skus.groupby('BRANDPRODUCT', sort=False, observed=True).size()
+    # Sorting by share once orders both period distributions by descending tonnage
+    significant_skus = brand_skus[brand_skus['Percentage'] >= 0.001].sort_values(
+        'Percentage', ascending=False, kind='stable')
+    brand_groups = dict(list(significant_skus.groupby('BRANDPRODUCT', sort=False, observed=True)))
+    
+    distribution_columns = {
+        'Item Code': 'SKU',
+        'Item Name': 'Product Name',
+        'Percentage': 'Percentage',
+        'TON': 'Historical Tonnage'
+    }
+    
+    def build_distribution(brand_skus_df, tonnage_col):
+        """Per-brand distribution table, already sorted by descending tonnage"""
+        columns = {**distribution_columns, tonnage_col: 'Predicted Tonnage'}
+        if brand_skus_df is None:
+            return pd.DataFrame(columns=list(columns.values()))
+        distribution = brand_skus_df[list(columns)].rename(columns=columns).reset_index(drop=True)
+        for col in ['SKU', 'Product Name']:
+            distribution[col] = distribution[col].astype(str)
+        return distribution[['SKU', 'Product Name', 'Predicted Tonnage', 'Percentage', 'Historical Tonnage']]
+    
     predictions = {}
     
     for brand, targets in brand_targets_agg.items():
-        current_brand_skus = brand_sku_percentages[brand_sku_percentages['BRANDPRODUCT'] == brand]
-        
-        if len(current_brand_skus) == 0:
+        if brand not in brand_sku_counts.index:
             st.warning(f"⚠️ No historical data for {brand}")
             continue
         
+        brand_skus_df = brand_groups.get(brand)
         predictions[brand] = {
             'mayTarget': targets['mayTarget'],
             'w1Target': targets['w1Target'],
             'historicalTonnage': targets.get('historicalTonnage', 0),
             'categories': targets['categories'],
-            'mayDistribution': {},
-            'w1Distribution': {},
-            'skuCount': len(current_brand_skus)
+            'mayDistribution': build_distribution(brand_skus_df, 'mayTon'),
+            'w1Distribution': build_distribution(brand_skus_df, 'w1Ton'),
+            'skuCount': int(brand_sku_counts[brand])
         }
-        
-        for _, sku_row in current_brand_skus.iterrows():
-            sku_code = sku_row['Item Code']
-            percentage = sku_row['Percentage']
-            item_name = sku_row['Item Name']
-            historical_sku_tonnage = sku_row['TON']
-
-            if percentage >= 0.001:
-                predictions[brand]['mayDistribution'][sku_code] = {
-                    'tonnage': targets['mayTarget'] * percentage,
-                    'percentage': percentage,
-                    'itemName': item_name,
-                    'historicalTonnage': historical_sku_tonnage
-                }
-                predictions[brand]['w1Distribution'][sku_code] = {
-                    'tonnage': targets['w1Target'] * percentage,
-                    'percentage': percentage,
-                    'itemName': item_name,
-                    'historicalTonnage': historical_sku_tonnage
-                }
     
     if predictions:
         st.success(f"✅ Generated predictions for {len(predictions)} brands")
@@ -397,7 +462,7 @@ def predict_sku_distribution(brand_targets_agg, historical_df):
         summary_data = []
         for brand, pred in predictions.items():
             historical_tonnage = pred.get('historicalTonnage', 0)
-            growth_may = pred['mayTarget'] / historical_tonnage if historical_tonnage > 0 else 0
+            growth_may = safe_ratio(pred['mayTarget'], historical_tonnage)
             
             summary_data.append({
                 'Brand': brand,
@@ -428,6 +493,7 @@ def setup_openai_api():
 
 def display_insights_section(brand_targets_agg, predictions, selected_brand):
     """Simple and working AI insights section"""
+    import plotly.express as px  # deferred: plotly is only needed once results exist
     
     st.subheader("🤖 AI Strategic Analysis")
     
@@ -435,7 +501,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
         # คำนวณข้อมูลพื้นฐาน
         total_may = sum(targets['mayTarget'] for targets in brand_targets_agg.values())
         total_historical = sum(targets.get('historicalTonnage', 0) for targets in brand_targets_agg.values())
-        growth_rate = (total_may / total_historical) if total_historical > 0 else 0
+        growth_rate = safe_ratio(total_may, total_historical)
         
         # แสดงผลสรุปทันที
         st.markdown("### 📊 Production Analysis Summary")
@@ -460,7 +526,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
         for brand, targets in brand_targets_agg.items():
             historical = targets.get('historicalTonnage', 0)
             may_target = targets['mayTarget']
-            brand_growth = may_target / historical if historical > 0 else 0
+            brand_growth = safe_ratio(may_target, historical)
             
             # ประเมินความเสี่ยง
             if brand_growth > 3:
@@ -595,7 +661,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
             for brand, targets in brand_targets_agg.items():
                 historical = targets.get('historicalTonnage', 0)
                 may_target = targets['mayTarget']
-                brand_growth = may_target / historical if historical > 0 else 0
+                brand_growth = safe_ratio(may_target, historical)
                 
                 if brand_growth > 3:
                     with st.expander(f"🔴 {brand} - High Risk Analysis"):
@@ -641,7 +707,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
                             sku_count = len(predictions.get(brand, {}).get('mayDistribution', {}))
                             total_skus += sku_count
                             
-                            growth_ratio = may_target / historical if historical > 0 else 0
+                            growth_ratio = safe_ratio(may_target, historical)
                             capacity_req = min((may_target / 1000) * 100, 100)  # Assuming 1000 tons max capacity
                             capacity_utilization += capacity_req
                             
@@ -1108,7 +1174,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
             },
             'brand_analysis': brand_data,
             'recommendations': recommendations,
-            'timestamp': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         
         # Add AI insights if available
@@ -1123,7 +1189,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
             st.download_button(
                 label="📄 Download Complete Analysis (JSON)",
                 data=analysis_json,
-                file_name=f"production_analysis_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.json",
+                file_name=f"production_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                 mime="application/json"
             )
         
@@ -1134,7 +1200,7 @@ def display_insights_section(brand_targets_agg, predictions, selected_brand):
             st.download_button(
                 label="📊 Download Brand Analysis (CSV)",
                 data=csv_data,
-                file_name=f"brand_analysis_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                file_name=f"brand_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                 mime="text/csv"
             )
         
@@ -1154,11 +1220,8 @@ def create_executive_summary(brand_targets_agg, predictions):
     }
     
     # Calculate growth
-    if summary_data["historical_total"] > 0:
-        may_growth = summary_data["may_total"] / summary_data["historical_total"]
-        w1_growth = summary_data["w1_total"] / summary_data["historical_total"]
-    else:
-        may_growth = w1_growth = 0
+    may_growth = safe_ratio(summary_data["may_total"], summary_data["historical_total"])
+    w1_growth = safe_ratio(summary_data["w1_total"], summary_data["historical_total"])
     
     # Show Executive Summary
     st.markdown("### 📋 Executive Summary")
@@ -1233,69 +1296,207 @@ def create_brand_selector(widget_key):
     )
     return st.session_state.selected_brand
 
+@st.cache_data(show_spinner=False)
+def build_brand_target_chart(brand_targets_agg, target_key, period_name):
+    """Build the brand target bar chart for one period - cached per period"""
+    import plotly.express as px
+    df_brand_targets = (pd.DataFrame.from_dict(brand_targets_agg, orient='index')[[target_key]]
+                        .rename_axis('Brand')
+                        .rename(columns={target_key: 'Tonnage'})
+                        .reset_index())
+    df_brand_targets = df_brand_targets[df_brand_targets['Tonnage'] > 0]
+    if df_brand_targets.empty:
+        return None
+    
+    return px.bar(
+        df_brand_targets, 
+        x='Brand', 
+        y='Tonnage', 
+        title=f"Brand Targets for {period_name}",
+        labels={'Tonnage':'Tons'},
+        color='Tonnage',
+        color_continuous_scale='Blues'
+    )
+
+def growth_ratio(predicted, historical, no_history=999.0):
+    """Predicted/historical tonnage rounded to 2 dp; SKUs without history get no_history"""
+    predicted = np.asarray(predicted, dtype=float)
+    historical = np.asarray(historical, dtype=float)
+    ratio = np.divide(predicted, historical, out=np.full_like(predicted, no_history), where=historical > 0)
+    return np.round(ratio, 2)
+
+@st.cache_data(show_spinner=False)
+def build_sku_bar_chart(display_df_sku, brand, period_name):
+    """Build the per-SKU tonnage bar chart - cached per brand, period and row selection"""
+    import plotly.express as px
+    
+    fig_sku_bar = px.bar(
+        display_df_sku, 
+        y='SKU', 
+        x='Predicted Tonnage', 
+        orientation='h',
+        title=f"SKU Distribution for {brand} ({period_name})",
+        labels={'Predicted Tonnage':'Tons'}, 
+        hover_data=['Product Name', 'Historical Tonnage', 'Growth Ratio'],
+        color='Growth Ratio',
+        color_continuous_scale='RdYlGn_r'
+    )
+    fig_sku_bar.update_layout(yaxis={'categoryorder':'total ascending'}, height=600, uirevision='sku_bar')
+    # No outline stroke around each bar, so long SKU lists draw fewer shapes
+    fig_sku_bar.update_traces(marker_line_width=0)
+    return fig_sku_bar
+
+@st.cache_data(show_spinner=False)
+def build_sku_pie_chart(df_sku_dist, brand, period_name, top_n_pie=8):
+    """Build the top-SKU pie chart with the remainder folded into 'Others'"""
+    import plotly.express as px
+    
+    top_skus = df_sku_dist.head(top_n_pie)
+    pie_data = {
+        'SKU': top_skus['SKU'].tolist(),
+        'Product Name': top_skus['Product Name'].tolist(),
+        'Predicted Tonnage': top_skus['Predicted Tonnage'].tolist()
+    }
+    if len(df_sku_dist) > top_n_pie:
+        others_tonnage = float(df_sku_dist['Predicted Tonnage'].iloc[top_n_pie:].sum())
+        if others_tonnage > 0.01:
+            pie_data['SKU'].append('Others')
+            pie_data['Product Name'].append(f'Others ({len(df_sku_dist) - top_n_pie} SKUs)')
+            pie_data['Predicted Tonnage'].append(others_tonnage)
+
+    return px.pie(
+        pie_data, 
+        values='Predicted Tonnage', 
+        names='SKU', 
+        title=f"Top SKU Proportion for {brand} ({period_name})", 
+        hover_data=['Product Name']
+    )
+
+@st.cache_data(show_spinner=False)
+def build_results_table(sku_distribution):
+    """Results-tab table for one brand and period - cached so filter changes skip the rebuild"""
+    df_results = sku_distribution.rename(columns={
+        'SKU': 'SKU Code', 
+        'Predicted Tonnage': 'Production Plan (tons)', 
+        'Percentage': 'Proportion (%)',
+        'Historical Tonnage': 'Historical Data (tons)'
+    })
+    
+    # Calculate Growth Ratio
+    df_results['Growth Ratio'] = growth_ratio(df_results['Production Plan (tons)'], df_results['Historical Data (tons)'])
+    
+    # Format data
+    return df_results.assign(**{'Proportion (%)': df_results['Proportion (%)'] * 100}).round({
+        'Production Plan (tons)': 3,
+        'Historical Data (tons)': 3
+    })
+
+@st.fragment
+def render_results_table(df_results):
+    """Filter selector and Results table - a filter change reruns only this fragment"""
+    filter_option = st.selectbox(
+        "Filter Data:",
+        ["All", "Production > 1 ton", "Production > 0.5 ton", "Growth > 3x", "Top 20 SKU"]
+    )
+    
+    if filter_option == "Production > 1 ton":
+        df_display = df_results[df_results['Production Plan (tons)'] > 1]
+    elif filter_option == "Production > 0.5 ton":
+        df_display = df_results[df_results['Production Plan (tons)'] > 0.5]
+    elif filter_option == "Growth > 3x":
+        df_display = df_results[df_results['Growth Ratio'] > 3]
+    elif filter_option == "Top 20 SKU":
+        df_display = df_results.head(20)
+    else:
+        df_display = df_results
+    
+    # Show table
+    st.dataframe(
+        df_display[['SKU Code', 'Product Name', 'Production Plan (tons)', 'Historical Data (tons)', 'Growth Ratio', 'Proportion (%)']],
+        column_config={'Proportion (%)': st.column_config.NumberColumn(format='%.2f%%')},
+        use_container_width=True,
+        height=400
+    )
+
+def write_dataframe_rows(worksheet, df):
+    """Write a DataFrame (header row first) strictly top-to-bottom, as constant_memory requires"""
+    worksheet.write_row(0, 0, list(df.columns))
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    for row_idx, row in enumerate(rows, start=1):
+        worksheet.write_row(row_idx, 0, row)
+
+def build_brand_sheet(brand, dist_data):
+    """Build the (sheet name, table) pair for one brand's Excel sheet"""
+    if dist_data is None or dist_data.empty:
+        return None
+    
+    df_dist = dist_data.rename(columns={'Percentage': 'Percentage (%)'})
+    
+    if 'Percentage (%)' in df_dist.columns:
+        df_dist['Percentage (%)'] = (df_dist['Percentage (%)'] * 100).round(2)
+    
+    if 'Predicted Tonnage' in df_dist.columns:
+        df_dist['Predicted Tonnage'] = df_dist['Predicted Tonnage'].round(4)
+    
+    if 'Historical Tonnage' in df_dist.columns:
+        df_dist['Historical Tonnage'] = df_dist['Historical Tonnage'].round(4)
+    
+    # Add Growth Ratio column
+    if 'Historical Tonnage' in df_dist.columns and 'Predicted Tonnage' in df_dist.columns:
+        df_dist['Growth Ratio'] = (df_dist['Predicted Tonnage'] / df_dist['Historical Tonnage']).round(2)
+        df_dist['Growth Ratio'] = df_dist['Growth Ratio'].replace([float('inf'), -float('inf')], 'N/A')
+    
+    final_columns_order = ['SKU', 'Product Name', 'Predicted Tonnage', 'Historical Tonnage', 'Growth Ratio', 'Percentage (%)']
+    output_df = df_dist.reindex(columns=[col for col in final_columns_order if col in df_dist.columns])
+    
+    sheet_name = brand.replace('/', '-').replace('\\', '-')
+    sheet_name = sheet_name[:31]
+    
+    return sheet_name, output_df
+
+@st.cache_data(show_spinner=False, max_entries=4)
 def generate_excel_download(predictions_data, selected_period_key):
     """Generate Excel file for download"""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Create summary sheet
-        summary_data = []
-        for brand, data in predictions_data.items():
-            period_dist_key = 'mayDistribution' if selected_period_key == 'may' else 'w1Distribution'
-            target_key = 'mayTarget' if selected_period_key == 'may' else 'w1Target'
-            
-            summary_data.append({
-                'Brand': brand,
-                'Target (Tons)': data[target_key],
-                'Historical (Tons)': data.get('historicalTonnage', 0),
-                'SKU Count': len(data.get(period_dist_key, {})),
-                'Categories': ', '.join(data.get('categories', []))
-            })
-        
-        summary_df = pd.DataFrame(summary_data)
-        summary_df.to_excel(writer, index=False, sheet_name='Summary')
-        
-        # Create sheet for each brand
-        for brand, data in predictions_data.items():
-            period_dist_key = 'mayDistribution' if selected_period_key == 'may' else 'w1Distribution'
-            dist_data = data.get(period_dist_key)
-
-            if dist_data:
-                df_dist = pd.DataFrame.from_dict(dist_data, orient='index').reset_index()
-                
-                rename_map = {
-                    'index': 'SKU',
-                    'itemName': 'Product Name',
-                    'tonnage': 'Predicted Tonnage',
-                    'percentage': 'Percentage (%)',
-                    'historicalTonnage': 'Historical Tonnage'
-                }
-                
-                df_dist.rename(columns=rename_map, inplace=True)
-                
-                if 'Percentage (%)' in df_dist.columns:
-                    df_dist['Percentage (%)'] = (df_dist['Percentage (%)'] * 100).round(2)
-                
-                if 'Predicted Tonnage' in df_dist.columns:
-                    df_dist['Predicted Tonnage'] = df_dist['Predicted Tonnage'].round(4)
-                
-                if 'Historical Tonnage' in df_dist.columns:
-                    df_dist['Historical Tonnage'] = df_dist['Historical Tonnage'].round(4)
-                
-                df_dist = df_dist.sort_values(by='Predicted Tonnage', ascending=False)
-                
-                # Add Growth Ratio column
-                if 'Historical Tonnage' in df_dist.columns and 'Predicted Tonnage' in df_dist.columns:
-                    df_dist['Growth Ratio'] = (df_dist['Predicted Tonnage'] / df_dist['Historical Tonnage']).round(2)
-                    df_dist['Growth Ratio'] = df_dist['Growth Ratio'].replace([float('inf'), -float('inf')], 'N/A')
-                
-                final_columns_order = ['SKU', 'Product Name', 'Predicted Tonnage', 'Historical Tonnage', 'Growth Ratio', 'Percentage (%)']
-                output_df = df_dist.reindex(columns=[col for col in final_columns_order if col in df_dist.columns])
-                
-                sheet_name = brand.replace('/', '-').replace('\\', '-')
-                sheet_name = sheet_name[:31]
-                
-                output_df.to_excel(writer, index=False, sheet_name=sheet_name)
+    # constant_memory flushes each row as it is written instead of buffering whole sheets
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    
+    # Create summary sheet
+    summary_data = []
+    for brand, data in predictions_data.items():
+        period_dist_key = 'mayDistribution' if selected_period_key == 'may' else 'w1Distribution'
+        target_key = 'mayTarget' if selected_period_key == 'may' else 'w1Target'
+        
+        summary_data.append({
+            'Brand': brand,
+            'Target (Tons)': data[target_key],
+            'Historical (Tons)': data.get('historicalTonnage', 0),
+            'SKU Count': len(data.get(period_dist_key, {})),
+            'Categories': ', '.join(data.get('categories', []))
+        })
     
+    summary_df = pd.DataFrame(summary_data)
+    write_dataframe_rows(workbook.add_worksheet('Summary'), summary_df)
+    
+    # Prepare brand sheets concurrently, then write them in order
+    period_dist_key = 'mayDistribution' if selected_period_key == 'may' else 'w1Distribution'
+    brand_items = [(brand, data.get(period_dist_key)) for brand, data in predictions_data.items()]
+    if len(brand_items) > 1:
+        # Sheet prep is light and mostly holds the GIL, so a few threads are plenty
+        with ThreadPoolExecutor(max_workers=min(len(brand_items), 4)) as executor:
+            brand_sheets = list(executor.map(lambda item: build_brand_sheet(*item), brand_items))
+    else:
+        brand_sheets = [build_brand_sheet(*item) for item in brand_items]
+    
+    for brand_sheet in brand_sheets:
+        if brand_sheet is not None:
+            sheet_name, output_df = brand_sheet
+            if workbook.get_worksheet_by_name(sheet_name) is not None:
+                # xlsxwriter rejects duplicate names (e.g. brands equal after truncation)
+                sheet_name = f"{sheet_name[:27]}-{len(workbook.worksheets())}"
+            write_dataframe_rows(workbook.add_worksheet(sheet_name), output_df)
+    
+    workbook.close()
     processed_data = output.getvalue()
     return processed_data
 
@@ -1305,7 +1506,8 @@ st.title("🏭 Production Planning Application")
 st.markdown("📊 Analyze historical data and targets to create precise SKU-level production plans")
 
 # Initialize session state
-for key in ['historical_df', 'category_targets', 'brand_targets_agg', 'predictions', 'selected_period', 'selected_brand']:
+for key in ['historical_df', 'category_targets', 'brand_targets_agg', 'predictions', 'selected_period', 'selected_brand',
+            'plan_filename_ts']:
     if key not in st.session_state:
         st.session_state[key] = None if key != 'selected_period' else 'may'
 
@@ -1321,7 +1523,7 @@ with tab1:
         historical_file = st.file_uploader("Upload Historical Excel File", type=['xlsx', 'xls'], key="hist")
         
         if historical_file:
-            st.session_state.historical_df = process_historical_file(historical_file)
+            st.session_state.historical_df = process_historical_file(historical_file.getvalue(), historical_file.name)
             if st.session_state.historical_df is not None:
                 st.success("✅ Historical data loaded successfully")
 
@@ -1330,7 +1532,7 @@ with tab1:
         target_file = st.file_uploader("Upload Target Excel File", type=['xlsx', 'xls'], key="target")
         
         if target_file:
-            st.session_state.category_targets = process_target_file(target_file)
+            st.session_state.category_targets = process_target_file(target_file.getvalue(), target_file.name)
             if st.session_state.category_targets:
                 st.success("✅ Target data loaded successfully")
 
@@ -1353,6 +1555,7 @@ with tab1:
                     # Generate predictions
                     st.session_state.predictions, _ = predict_sku_distribution(
                         st.session_state.brand_targets_agg, filtered_historical)
+                    st.session_state.plan_filename_ts = None  # new plan, new download name
                     
                     if st.session_state.predictions:
                         st.success("🎉 SKU distribution generated successfully!")
@@ -1365,7 +1568,9 @@ with tab1:
             except Exception as e:
                 st.error(f"❌ Processing error: {str(e)}")
 
-with tab2:
+@st.fragment
+def render_analysis_tab():
+    """Analysis tab body - its selectors rerun only this fragment, not the whole app"""
     st.header("📊 Analysis")
     if not st.session_state.predictions:
         st.info("📝 Please upload data and generate SKU distribution first")
@@ -1379,23 +1584,10 @@ with tab2:
         
         st.subheader("📈 Brand Target Distribution")
         if st.session_state.brand_targets_agg:
-            brand_target_data = []
             target_key = 'mayTarget' if st.session_state.selected_period == 'may' else 'w1Target'
-            for brand, targets in st.session_state.brand_targets_agg.items():
-                if targets[target_key] > 0:
-                    brand_target_data.append({'Brand': brand, 'Tonnage': targets[target_key]})
-            
-            if brand_target_data:
-                df_brand_targets = pd.DataFrame(brand_target_data)
-                fig_brand_targets = px.bar(
-                    df_brand_targets, 
-                    x='Brand', 
-                    y='Tonnage', 
-                    title=f"Brand Targets for {selected_period_name}",
-                    labels={'Tonnage':'Tons'},
-                    color='Tonnage',
-                    color_continuous_scale='Blues'
-                )
+            fig_brand_targets = build_brand_target_chart(
+                st.session_state.brand_targets_agg, target_key, selected_period_name)
+            if fig_brand_targets is not None:
                 st.plotly_chart(fig_brand_targets, use_container_width=True)
 
         st.divider()
@@ -1412,86 +1604,51 @@ with tab2:
             dist_key = 'mayDistribution' if st.session_state.selected_period == 'may' else 'w1Distribution'
             sku_distribution = brand_data.get(dist_key)
 
-            if sku_distribution:
-                df_sku_dist = pd.DataFrame.from_dict(sku_distribution, orient='index').reset_index()
-                df_sku_dist.rename(columns={
-                    'index': 'SKU', 
-                    'itemName': 'Product Name', 
-                    'tonnage': 'Predicted Tonnage', 
-                    'percentage': 'Percentage',
-                    'historicalTonnage': 'Historical Tonnage'
-                }, inplace=True)
-                df_sku_dist = df_sku_dist.sort_values(by='Predicted Tonnage', ascending=False)
+            if sku_distribution is not None and not sku_distribution.empty:
+                df_sku_dist = sku_distribution.copy()
                 
                 # Add Growth Ratio column
                 if 'Historical Tonnage' in df_sku_dist.columns:
-                    df_sku_dist['Growth Ratio'] = (df_sku_dist['Predicted Tonnage'] / df_sku_dist['Historical Tonnage']).round(2)
-                    df_sku_dist['Growth Ratio'] = df_sku_dist['Growth Ratio'].replace([float('inf')], 999.0)
+                    df_sku_dist['Growth Ratio'] = growth_ratio(df_sku_dist['Predicted Tonnage'], df_sku_dist['Historical Tonnage'])
                 
                 display_df_sku = df_sku_dist if show_all_skus else df_sku_dist.head(15)
                 
                 if not display_df_sku.empty:
                     # Show statistics summary
+                    total_target = df_sku_dist['Predicted Tonnage'].sum()
+                    total_historical = df_sku_dist['Historical Tonnage'].sum()
                     col1, col2, col3, col4 = st.columns(4)
                     with col1:
                         st.metric("SKU Count", len(df_sku_dist))
                     with col2:
-                        total_target = df_sku_dist['Predicted Tonnage'].sum()
                         st.metric("Total Target", f"{total_target:.1f} tons")
                     with col3:
-                        total_historical = df_sku_dist['Historical Tonnage'].sum()
                         st.metric("Total Historical", f"{total_historical:.1f} tons")
                     with col4:
-                        overall_growth = total_target / total_historical if total_historical > 0 else 0
+                        overall_growth = safe_ratio(total_target, total_historical)
                         st.metric("Growth", f"{overall_growth:.1f}x")
                     
                     # Bar chart
-                    fig_sku_bar = px.bar(
-                        display_df_sku, 
-                        y='SKU', 
-                        x='Predicted Tonnage', 
-                        orientation='h',
-                        title=f"SKU Distribution for {selected_brand} ({selected_period_name})",
-                        labels={'Predicted Tonnage':'Tons'}, 
-                        hover_data=['Product Name', 'Historical Tonnage', 'Growth Ratio'],
-                        color='Growth Ratio',
-                        color_continuous_scale='RdYlGn_r'
-                    )
-                    fig_sku_bar.update_layout(yaxis={'categoryorder':'total ascending'}, height=600)
+                    fig_sku_bar = build_sku_bar_chart(display_df_sku, selected_brand, selected_period_name)
                     st.plotly_chart(fig_sku_bar, use_container_width=True)
 
                     # Pie chart (Top SKUs)
-                    top_n_pie = 8
-                    df_pie_data = df_sku_dist.head(top_n_pie).copy()
-                    if len(df_sku_dist) > top_n_pie:
-                        others_tonnage = df_sku_dist.iloc[top_n_pie:]['Predicted Tonnage'].sum()
-                        if others_tonnage > 0.01:
-                            others_row = pd.DataFrame([{
-                                'SKU': 'Others', 
-                                'Product Name': f'Others ({len(df_sku_dist) - top_n_pie} SKUs)', 
-                                'Predicted Tonnage': others_tonnage, 
-                                'Percentage': 0.0
-                            }])
-                            df_pie_data = pd.concat([df_pie_data, others_row], ignore_index=True)
-
-                    fig_sku_pie = px.pie(
-                        df_pie_data, 
-                        values='Predicted Tonnage', 
-                        names='SKU', 
-                        title=f"Top SKU Proportion for {selected_brand} ({selected_period_name})", 
-                        hover_data=['Product Name']
-                    )
+                    fig_sku_pie = build_sku_pie_chart(df_sku_dist, selected_brand, selected_period_name)
                     st.plotly_chart(fig_sku_pie, use_container_width=True)
                     
                     # Data table
                     st.subheader("📋 SKU Details")
                     display_columns = ['SKU', 'Product Name', 'Predicted Tonnage', 'Historical Tonnage', 'Growth Ratio', 'Percentage']
-                    display_table = display_df_sku[display_columns].copy()
-                    display_table['Predicted Tonnage'] = display_table['Predicted Tonnage'].round(3)
-                    display_table['Historical Tonnage'] = display_table['Historical Tonnage'].round(3)
-                    display_table['Percentage'] = (display_table['Percentage'] * 100).round(2)
-                    
-                    st.dataframe(display_table, use_container_width=True)
+                    st.dataframe(
+                        display_df_sku[display_columns],
+                        column_config={
+                            'Predicted Tonnage': st.column_config.NumberColumn(format='%.3f'),
+                            'Historical Tonnage': st.column_config.NumberColumn(format='%.3f'),
+                            'Growth Ratio': st.column_config.NumberColumn(format='%.2f'),
+                            'Percentage': st.column_config.NumberColumn(format='percent')
+                        },
+                        use_container_width=True
+                    )
             else:
                 st.warning(f"No SKU distribution data for {selected_brand} in {selected_period_name}")
 
@@ -1505,7 +1662,9 @@ with tab2:
                 selected_brand
             )
 
-with tab3:
+@st.fragment
+def render_results_tab():
+    """Results tab body - its selectors rerun only this fragment, not the whole app"""
     st.header("📋 Production Plan Results")
     if not st.session_state.predictions:
         st.info("📝 Please upload data and generate SKU distribution first")
@@ -1518,69 +1677,32 @@ with tab3:
             dist_key_res = 'mayDistribution' if st.session_state.selected_period == 'may' else 'w1Distribution'
             sku_distribution_res = brand_data_res.get(dist_key_res)
 
-            if sku_distribution_res:
+            if sku_distribution_res is not None and not sku_distribution_res.empty:
                 st.subheader(f"📊 Production Plan: {selected_brand_res} - {selected_period_name_results}")
                 
-                df_results = pd.DataFrame.from_dict(sku_distribution_res, orient='index').reset_index()
-                df_results.rename(columns={
-                    'index': 'SKU Code', 
-                    'itemName': 'Product Name', 
-                    'tonnage': 'Production Plan (tons)', 
-                    'percentage': 'Proportion (%)',
-                    'historicalTonnage': 'Historical Data (tons)'
-                }, inplace=True)
-                
-                # Calculate Growth Ratio
-                df_results['Growth Ratio'] = (df_results['Production Plan (tons)'] / df_results['Historical Data (tons)']).round(2)
-                df_results['Growth Ratio'] = df_results['Growth Ratio'].replace([float('inf')], 999.0)
-                
-                # Format data
-                df_results['Proportion (%)'] = (df_results['Proportion (%)'] * 100).round(2)
-                df_results['Production Plan (tons)'] = df_results['Production Plan (tons)'].round(3)
-                df_results['Historical Data (tons)'] = df_results['Historical Data (tons)'].round(3)
-                
-                # Sort by production plan
-                df_results = df_results.sort_values(by='Production Plan (tons)', ascending=False)
+                df_results = build_results_table(sku_distribution_res)
                 
                 # Show summary statistics
+                total_plan = df_results['Production Plan (tons)'].sum()
+                total_hist = df_results['Historical Data (tons)'].sum()
                 col1, col2, col3, col4 = st.columns(4)
                 with col1:
-                    st.metric("🎯 Total Target", f"{df_results['Production Plan (tons)'].sum():.1f} tons")
+                    st.metric("🎯 Total Target", f"{total_plan:.1f} tons")
                 with col2:
-                    st.metric("📈 Historical Total", f"{df_results['Historical Data (tons)'].sum():.1f} tons")
+                    st.metric("📈 Historical Total", f"{total_hist:.1f} tons")
                 with col3:
-                    total_growth = df_results['Production Plan (tons)'].sum() / df_results['Historical Data (tons)'].sum()
+                    total_growth = safe_ratio(total_plan, total_hist)
                     st.metric("📊 Overall Growth", f"{total_growth:.1f}x")
                 with col4:
                     st.metric("🔢 SKU Count", len(df_results))
                 
-                # Data filtering
-                filter_option = st.selectbox(
-                    "Filter Data:",
-                    ["All", "Production > 1 ton", "Production > 0.5 ton", "Growth > 3x", "Top 20 SKU"]
-                )
-                
-                if filter_option == "Production > 1 ton":
-                    df_display = df_results[df_results['Production Plan (tons)'] > 1]
-                elif filter_option == "Production > 0.5 ton":
-                    df_display = df_results[df_results['Production Plan (tons)'] > 0.5]
-                elif filter_option == "Growth > 3x":
-                    df_display = df_results[df_results['Growth Ratio'] > 3]
-                elif filter_option == "Top 20 SKU":
-                    df_display = df_results.head(20)
-                else:
-                    df_display = df_results
-                
-                # Show table
-                st.dataframe(
-                    df_display[['SKU Code', 'Product Name', 'Production Plan (tons)', 'Historical Data (tons)', 'Growth Ratio', 'Proportion (%)']],
-                    use_container_width=True,
-                    height=400
-                )
+                # Data filtering and table
+                render_results_table(df_results)
                 
                 # Show warnings for high growth SKUs
-                high_growth_skus = df_results[df_results['Growth Ratio'] > 5]
-                if len(high_growth_skus) > 0:
+                high_growth = df_results['Growth Ratio'].to_numpy() > 5
+                if high_growth.any():
+                    high_growth_skus = df_results[high_growth]
                     st.warning(f"⚠️ **Found SKUs with very high growth ({len(high_growth_skus)} items):**")
                     st.dataframe(
                         high_growth_skus[['SKU Code', 'Product Name', 'Production Plan (tons)', 'Growth Ratio']].head(10),
@@ -1597,11 +1719,14 @@ with tab3:
             col_download1, col_download2 = st.columns(2)
             
             with col_download1:
+                # Stamp the file name once per generated plan so it stays stable across reruns
+                if st.session_state.plan_filename_ts is None:
+                    st.session_state.plan_filename_ts = datetime.now().strftime('%Y%m%d_%H%M%S')
                 excel_bytes = generate_excel_download(st.session_state.predictions, st.session_state.selected_period)
                 st.download_button(
                     label="📊 Download Complete Results as Excel",
                     data=excel_bytes,
-                    file_name=f"production_plan_{st.session_state.selected_period}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                    file_name=f"production_plan_{st.session_state.selected_period}_{st.session_state.plan_filename_ts}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     type="primary"
                 )
@@ -1612,5 +1737,11 @@ with tab3:
                        "- Individual Brand sheets: Detailed SKU data with comparisons\n"
                        "- Growth Ratio: Growth rate for each SKU")
 
+with tab2:
+    render_analysis_tab()
+
+with tab3:
+    render_results_tab()
+
 st.divider()
 st.markdown("🏭 **Production Planning App** | 📊 Precise SKU-level production planning")